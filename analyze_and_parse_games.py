@@ -4,19 +4,107 @@ import chess.pgn
 import chess.engine
 import math
 import csv
+import numpy as np
 import re
-import io
-import requests
-from bs4 import BeautifulSoup
+import requests_cache
+import html
 import asyncio
+import itertools
+import functools
+from datetime import timedelta
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor
+try: #orjson is a lot faster for the big .txt files, but the standard library json works too if it isn't installed
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# eco.csv is a seed cache of opening names for the ECOUrls of the games bundled with this repo (taken from Chess_database.csv). It only covers the openings reached in those games,
+# so other players' games will mostly miss it and fall back to downloading the ECOUrl page (cached in eco_cache.sqlite by get_eco_session).
+# ECOUrl is the key rather than the ECO code because one ECO code covers many different openings and variations on chess.com.
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "eco.csv"), newline='', encoding='utf-8') as eco_file:
+    eco_opening_names = {row["ECOUrl"]: row["Full Opening Name"] for row in csv.DictReader(eco_file)}
+
+# The session for downloading ECOUrl pages. Created by get_eco_session the first time a page is needed, once per process.
+eco_session = None
+eco_session_pid = None
+
+# Only the <title> of the ECOUrl page is needed, so a regex is much cheaper than building the whole page with an HTML parser
+title_re = re.compile(rb"<title>(.*?)</title>", re.I | re.S)
+main_opening_re = re.compile(r"(.*?):") #main opening name is everything before the colon (e.g. 'Pirc Defense')
+variation_opening_re = re.compile(r": ?(.*)") #variation name is everything after it (e.g. 'Classical, Quiet System')
+
+# PGN headers written to the CSV, in the same order as the first columns of the CSV. Always using this list keeps the columns lined up even if a game is missing a header or has extra ones.
+canonical_pgn_headers = (
+    "Event", "Site", "Date", "Round", "White", "Black", "Result", "CurrentPosition", "Timezone", "ECO", "ECOUrl", "UTCDate", "UTCTime", "WhiteElo", "BlackElo",
+    "TimeControl", "Termination", "StartTime", "EndDate", "EndTime", "Link"
+    )
+
+# How deep Stockfish searches each position. Search time grows exponentially with depth, so e.g. chess.engine.Limit(nodes=200_000) is a faster alternative that is still deterministic with single-threaded engines.
+default_analysis_limit = chess.engine.Limit(depth=18)
+
+# Each worker process started by parse_pgn_to_csv keeps its own event loop and Stockfish engines for all of the games it analyzes
+worker_loop = None
+worker_engines = []
+worker_analysis_limit = default_analysis_limit
+worker_games_accuracies = {}
+
+class HeadersAndMovesVisitor(chess.pgn.BaseVisitor):
+    """
+    Visitor for chess.pgn.read_game() that only keeps what the analysis needs: the headers and the mainline moves.
+    By default read_game() builds a full game tree with every comment and variation, which isn't needed here (chess.com puts a clock comment on every move).
+
+    Returns (from read_game):
+        headers (Headers): the game's headers
+        moves (list): the mainline moves of the game, as chess.Move objects
+    """
+    def begin_game(self):
+        self.headers = chess.pgn.Headers() #starts with the same "?" defaults for the seven tag roster as a normal Game
+        self.moves = []
+        self.errors = []
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP #only the mainline is analyzed
+
+    def visit_move(self, board, move):
+        self.moves.append(move)
 
-async def analyze_game(game, stockfish_path):
+    def handle_error(self, error):
+        # Same as chess.pgn.GameBuilder: log the error and keep going, rather than the BaseVisitor default of raising it and stopping the whole run
+        chess.pgn.LOGGER.error("%s while parsing %r", error, self.headers)
+        self.errors.append(error)
+
+    def result(self):
+        return self.headers, self.moves
+
+async def analyze_positions(engine, queue, scores, analysis_limit):
+    """
+    Worker coroutine for analyze_game. Takes positions off the queue and analyzes them until the queue is empty.
+
+    Args:
+        engine (UciProtocol): running Stockfish engine from open_engine(). Each worker gets its own engine.
+        queue (asyncio.Queue): queue of (index, board) tuples, one for each position in the game
+        scores (numpy array): array to store the evaluation of each position in, in centipawns from white's point of view
+        analysis_limit (Limit): how long Stockfish searches each position
+    """
+    while not queue.empty():
+        index, position = queue.get_nowait()
+        info = await engine.analyse(position, analysis_limit, info=chess.engine.INFO_SCORE) #only the score is needed, so Stockfish's pv and other info isn't parsed
+        scores[index] = info["score"].white().score(mate_score=1000)
+
+async def analyze_game(headers, moves, engines, analysis_limit=default_analysis_limit):
     """
     Analyzes a chess game from a PGN file using Stockfish.
+    Every position is independent of the others, so the positions are split between all the engines and analyzed at the same time.
     
     Args:
-        game (game from python-chess): game type object resulting from python-chess' chess.pgn.read_game()
-        stockfish_path (str): string containing the path of local stockfish executable
+        headers (Headers): the game's headers, as read by HeadersAndMovesVisitor
+        moves (list): the mainline moves of the game, as read by HeadersAndMovesVisitor
+        engines (list): list of running Stockfish engines from open_engine(). They are reused across games, so they are not closed here.
+        analysis_limit (Limit, optional): how long Stockfish searches each position. Defaults to default_analysis_limit (depth 18).
 
     Returns:
         white_mistakes (list): list containing the move numbers where white made mistakes
@@ -28,50 +116,82 @@ async def analyze_game(game, stockfish_path):
     mistake = 100 #defining mistake as a centipawn loss of 100 or more
     blunder = 300 #defining blunder as a centipawn loss of 300 or more
 
-    board = game.board()
-    transport, engine = await chess.engine.popen_uci(stockfish_path)
+    board = headers.board() #starting position, which also handles games that were set up from a FEN
+
+    print(f"Analyzing game: {headers['Event']} - {headers['White']} vs {headers['Black']}")
 
-    await engine.configure({"Threads": 10}) #Uitilizing 10 threads, you can modify this number depending on the threads available on your CPU. 
+    # copy(stack=False) snapshots each position without its move history, which is much cheaper than writing it out as a FEN and parsing it back in
+    positions = [board.copy(stack=False)] #the starting position is analyzed too, so the first move is compared against it
+    for move in moves:
+        board.push(move)
+        positions.append(board.copy(stack=False))
 
-    print(f"Analyzing game: {game.headers['Event']} - {game.headers['White']} vs {game.headers['Black']}")
+    queue = asyncio.Queue()
+    for index, position in enumerate(positions):
+        queue.put_nowait((index, position))
 
-    combined_move_num = 1
-    black_mistakes = []
-    black_blunders = []
-    white_mistakes = []
-    white_blunders = []
+    scores = np.empty(len(positions), dtype=np.int32)
+    await asyncio.gather(*(analyze_positions(engine, queue, scores, analysis_limit) for engine in engines))
 
-    for move in game.mainline_moves():
-        board.push(move)
-        info = await engine.analyse(board, chess.engine.Limit(depth=18))
+    deltas = np.diff(scores) #change in evaluation caused by each move
+    move_nums = np.arange(len(deltas)) // 2 + 1 #this is how I'm handling the fact that in chess the move number technically doesn't increase until both players have moved. 
+    move_num = int(math.ceil(len(deltas) / 2))
+
+    black_blunders = move_nums[deltas >= blunder].tolist()
+    black_mistakes = move_nums[(deltas >= mistake) & (deltas < blunder)].tolist()
+    white_blunders = move_nums[deltas <= 0 - blunder].tolist()
+    white_mistakes = move_nums[(deltas <= 0 - mistake) & (deltas > 0 - blunder)].tolist()
+
+    return white_mistakes, white_blunders, black_mistakes, black_blunders, move_num
 
-        try:
-            old_score = score
-        except UnboundLocalError:
-            old_score = info["score"].white().score(mate_score=1000)
+async def open_engine(stockfish_path):
+    """
+    Starts a single-threaded Stockfish process that can be reused for every game in the PGN.
+    Starting Stockfish (UCI handshake, NNUE load, hash allocation) is slow, and keeping it alive also keeps its hash table warm between games.
+    Several single-threaded engines analyzing different positions at once are faster than one multi-threaded engine analyzing them one at a time.
 
-        move_num = int(math.ceil(combined_move_num / 2)) #this is how I'm handling the fact that in chess the move number technically doesn't increase until both players have moved. 
+    Args:
+        stockfish_path (str): string containing the path of local stockfish executable
 
-        score = info["score"].white().score(mate_score=1000)
- 
-        if score - old_score >= blunder:
-            black_blunders.append(move_num)
-        elif score - old_score >= mistake: 
-            black_mistakes.append(move_num)
-        elif score - old_score <= 0 - blunder:
-             white_blunders.append(move_num)
-        elif score - old_score <= 0 - mistake:
-             white_mistakes.append(move_num)
+    Returns:
+        engine (UciProtocol): the running Stockfish engine. Call engine.quit() when done.
+    """
+    transport, engine = await chess.engine.popen_uci(stockfish_path)
 
-        combined_move_num += 1
+    await engine.configure({"Hash": 256, "Threads": 1})
 
-    await engine.quit()
+    return engine
 
-    return white_mistakes, white_blunders, black_mistakes, black_blunders, move_num
+async def quit_engines(engines):
+    """
+    Quits all of the Stockfish engines at the same time.
+
+    Args:
+        engines (list): list of running Stockfish engines from open_engine()
+    """
+    await asyncio.gather(*(engine.quit() for engine in engines))
 
+def get_eco_session():
+    """
+    Returns the session for downloading ECOUrl pages, creating it the first time it is needed in this process.
+    The same openings come up over and over, so the pages are cached on disk between runs instead of being downloaded for every game.
+    The cache is a SQLite database, and a SQLite connection can't be shared with a forked worker process, so each process opens its own.
+
+    Returns:
+        eco_session (CachedSession): requests session that caches the ECOUrl pages in eco_cache.sqlite
+    """
+    global eco_session, eco_session_pid
+
+    if eco_session is None or eco_session_pid != os.getpid():
+        eco_session = requests_cache.CachedSession('eco_cache', expire_after=timedelta(days=30), backend='sqlite')
+        eco_session_pid = os.getpid()
+
+    return eco_session
+
+@functools.lru_cache(maxsize=4096)
 def get_opening_name(eco_url):
     """
-    Parses opening name from the ECOUrl using a combination of BeautifulSoup and re. 
+    Looks up the opening name for the ECOUrl in the eco.csv seed cache. If it isn't there, parses the opening name from the title of the ECOUrl page using re. 
 
     Args:
         eco_url (str): the url for the ECO code as provided by PGN
@@ -82,14 +202,16 @@ def get_opening_name(eco_url):
         variation_opening_name (str): variation opening name (e.g. 'Classical, Quiet System')
 
     """
-    eco_url_contents = requests.get(eco_url).text
-    soup = BeautifulSoup(eco_url_contents, 'html.parser')
-    title = soup.title.string
+    full_opening_name = eco_opening_names.get(eco_url)
+    if full_opening_name is None: #opening isn't in the seed cache, so fall back to downloading the ECOUrl page
+        eco_url_contents = get_eco_session().get(eco_url).content
+        title = html.unescape(title_re.search(eco_url_contents).group(1).decode('utf-8', 'ignore')) #unescape turns html entities (e.g. &#x27; in King's Indian) back into regular characters
+
+        full_opening_name = title[:-29] #removes the standard " - Chess Openings - Chess.com'" text from the title to isolate the opening name.
 
-    full_opening_name = title[:-29] #removes the standard " - Chess Openings - Chess.com'" text from the title to isolate the opening name.
     try: #Need to catch errors when there is no variation listed (e.g. mainline opening was played)
-        main_opening_name = re.search(".*?:", full_opening_name).group(0)[:-1]
-        variation_opening_name = re.search(":.*", full_opening_name).group(0)[2:]
+        main_opening_name = main_opening_re.search(full_opening_name).group(1)
+        variation_opening_name = variation_opening_re.search(full_opening_name).group(1)
     except AttributeError:
         main_opening_name = full_opening_name
         variation_opening_name = ""
@@ -97,7 +219,108 @@ def get_opening_name(eco_url):
     return full_opening_name, main_opening_name, variation_opening_name
 
 
-def parse_pgn_to_csv(pgn_path, txt_path, user_name, stockfish_path, csv_path="chess_games_data.csv"):
+def init_worker(stockfish_path, engine_count, analysis_limit, games_accuracies):
+    """
+    Starts the event loop and Stockfish engines for a worker process. Used as the initializer of the process pool in parse_pgn_to_csv.
+    Also registers close_worker_engines to quit the engines when the worker process exits.
+
+    Args:
+        stockfish_path (str): string containing the path of local stockfish executable
+        engine_count (int): number of single-threaded Stockfish engines to start for this worker
+        analysis_limit (Limit): how long Stockfish searches each position
+        games_accuracies (dict): the "accuracies" of every game in the .txt file, keyed by the game's url
+    """
+    global worker_loop, worker_engines, worker_analysis_limit, worker_games_accuracies
+
+    worker_analysis_limit = analysis_limit
+    worker_games_accuracies = games_accuracies
+
+    worker_loop = asyncio.new_event_loop()
+    worker_engines = [worker_loop.run_until_complete(open_engine(stockfish_path)) for _ in range(engine_count)]
+
+    # Pool workers exit without running atexit handlers, but multiprocessing still runs its own finalizers on the way out
+    multiprocessing.util.Finalize(None, close_worker_engines, exitpriority=10)
+
+def close_worker_engines():
+    """
+    Quits the worker process' Stockfish engines and closes its event loop. Registered by init_worker to run when the worker process exits.
+    """
+    worker_loop.run_until_complete(quit_engines(worker_engines))
+    worker_loop.close()
+
+def read_pgn_games(pgn_file):
+    """
+    Reads the games from a PGN file one at a time with HeadersAndMovesVisitor, so they can be sent to the worker processes.
+    Only the headers and mainline moves are kept, so reading the games is cheap compared to analyzing them.
+
+    Args:
+        pgn_file (file): the opened .pgn file
+
+    Yields:
+        game (tuple): the game's headers and mainline moves, as read by HeadersAndMovesVisitor
+    """
+    while True:
+        game = chess.pgn.read_game(pgn_file, Visitor=HeadersAndMovesVisitor)
+
+        if game is None:
+            break # No more games in the PGN file
+
+        yield game
+
+def analyze_one_game(game, user_name):
+    """
+    Analyzes a single game and builds its row for the CSV file. Runs inside a worker process set up by init_worker.
+
+    Args:
+        game (tuple): the game's headers and mainline moves, as produced by read_pgn_games
+        user_name (str): Needed for win/loss/draw column. 
+
+    Returns:
+        row_data (list): the values for the game's row in the CSV file
+    """
+    headers, moves = game
+
+    # The Link header is the same as the game's url in the .txt file. Empty if the game isn't in the .txt file or chess.com didn't calculate the accuracies.
+    accuracies = worker_games_accuracies.get(headers.get("Link"), {})
+    white_accuracy = accuracies.get("white", "")
+    black_accuracy = accuracies.get("black", "")
+
+    white_mistakes, white_blunders, black_mistakes, black_blunders, move_num = worker_loop.run_until_complete(analyze_game(headers, moves, worker_engines, worker_analysis_limit))
+
+    # Create a list for the current row's data
+    row_data = [headers.get(header_name, "") for header_name in canonical_pgn_headers] # Get the header values, use an empty string if missing
+    
+    full_opening_name, main_opening_name, variation_opening_name = get_opening_name(row_data[10])
+
+    row_data.extend([full_opening_name, main_opening_name, variation_opening_name])
+
+    if row_data[6] == "1-0" and row_data[4] == user_name:
+        row_data.append("Win")
+    elif row_data[6] == "1-0" and row_data[5] == user_name:
+        row_data.append("Loss")
+    elif row_data[6] == "0-1" and row_data[5] == user_name:
+        row_data.append("Win")
+    elif row_data[6] == "0-1" and row_data[4] == user_name:
+        row_data.append("Loss")
+    elif row_data[6] == "1/2-1/2" and (row_data[4] == user_name or row_data[5] == user_name):
+        row_data.append("Draw")
+    else:
+        "uhhh you didn't play in this game..."
+
+    
+    row_data.extend([move_num, white_accuracy, black_accuracy, len(black_blunders), len(black_mistakes), len(white_blunders), len(white_mistakes)])
+
+    # First of each, left empty if there weren't any
+    row_data.extend([
+        black_blunders[0] if black_blunders else '',
+        black_mistakes[0] if black_mistakes else '',
+        white_blunders[0] if white_blunders else '',
+        white_mistakes[0] if white_mistakes else ''
+        ])
+
+    return row_data
+
+def parse_pgn_to_csv(pgn_path, txt_path, user_name, stockfish_path, csv_path="chess_games_data.csv", analysis_limit=default_analysis_limit):
     """
     Parses a PGN file and .txt file, extracts game metadata, and saves it to a CSV file.
 
@@ -106,6 +329,7 @@ def parse_pgn_to_csv(pgn_path, txt_path, user_name, stockfish_path, csv_path="ch
         txt_path (str): The path to the input .txt file.
         user_name (str): Needed for win/loss/draw column. 
         csv_path (str, optional): The path to the output CSV file. Defaults to "chess_games_data.csv".
+        analysis_limit (Limit, optional): how long Stockfish searches each position. Defaults to default_analysis_limit (depth 18).
     """
 
     try:
@@ -114,12 +338,30 @@ def parse_pgn_to_csv(pgn_path, txt_path, user_name, stockfish_path, csv_path="ch
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        with open(txt_path, 'r', encoding='utf-8') as txt_file:
-            games_data = re.findall(r"\"pgn\":.*?eco\":", txt_file.read(), flags = re.DOTALL) 
+        # The .txt file is chess.com's JSON. After merge_files there is one month of games per line.
+        # The accuracies are keyed by each game's url so they can be matched to the Link header of the game in the PGN, whatever order the two files are in.
+        games_accuracies = {}
+        with open(txt_path, 'rb', buffering=1 << 20) as txt_file: #1 MB buffer instead of the default 8 KB, the files can get very large
+            for line_num, line in enumerate(txt_file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    games_json = json_loads(line)["games"]
+                except (ValueError, KeyError): #e.g. a download that was cut off
+                    print(f"Warning: skipping line {line_num} of '{txt_path}', it isn't a complete chess.com game archive")
+                    continue
+                for game_json in games_json:
+                    games_accuracies[game_json.get("url")] = game_json.get("accuracies") or {}
+
+        # Games are independent, so they are analyzed by a pool of worker processes. Each worker keeps its own Stockfish engines for all of its games.
+        cpu_count = os.cpu_count() or 1
+        worker_count = max(1, cpu_count // 2) #a worker mostly waits on Stockfish, so half of the CPUs is plenty
+        engines_per_worker = max(1, cpu_count // worker_count) #gives one single-threaded Stockfish per CPU across all of the workers
 
         # Open the PGN for reading and the CSV file for writing
-        with open(pgn_path, 'r', encoding='utf-8') as pgn_file, \
-             open(csv_path, 'w', newline='', encoding='utf-8') as csv_file: 
+        with open(pgn_path, 'r', encoding='utf-8', buffering=1 << 20) as pgn_file, \
+             open(csv_path, 'w', newline='', encoding='utf-8', buffering=1 << 20) as csv_file, \
+             ProcessPoolExecutor(max_workers=worker_count, initializer=init_worker, initargs=(stockfish_path, engines_per_worker, analysis_limit, games_accuracies)) as executor: 
 
             writer = csv.writer(csv_file)
 
@@ -132,72 +374,8 @@ def parse_pgn_to_csv(pgn_path, txt_path, user_name, stockfish_path, csv_path="ch
                 ]
             writer.writerow(headers) # Write the header row to the CSV
 
-            game_count = 0 # Read games one by one from the PGN file
-            while True:
-                game = chess.pgn.read_game(pgn_file) 
-            
-                if game is None:
-                    break # No more games in the PGN file
-                
-                try:
-                    accuracies = re.search("\"accuracies\":{\"white\":.*?}", games_data[game_count]).group(0)
-                    white_accuracy = re.search("\"white\":.*?,", accuracies).group(0)[8:-1]
-                    black_accuracy = re.search("\"black\":.*?}", accuracies).group(0)[8:-1]
-                except AttributeError:
-                    white_accuracy = ""
-                    black_accuracy = ""
-
-                white_mistakes, white_blunders, black_mistakes, black_blunders, move_num = asyncio.run(analyze_game(game, stockfish_path))
-
-                headers = game.headers # Get the game's headers
-
-                # Create a list for the current row's data
-                row_data = []
-                for header_name in headers:
-                    # Get the header value, use an empty string if missing
-                    value = headers.get(header_name, "")
-                    row_data.append(value)     
-                
-                full_opening_name, main_opening_name, variation_opening_name = get_opening_name(row_data[10])
-
-                row_data.extend([full_opening_name, main_opening_name, variation_opening_name])
-
-                if row_data[6] == "1-0" and row_data[4] == user_name:
-                    row_data.append("Win")
-                elif row_data[6] == "1-0" and row_data[5] == user_name:
-                    row_data.append("Loss")
-                elif row_data[6] == "0-1" and row_data[5] == user_name:
-                    row_data.append("Win")
-                elif row_data[6] == "0-1" and row_data[4] == user_name:
-                    row_data.append("Loss")
-                elif row_data[6] == "1/2-1/2" and (row_data[4] == user_name or row_data[5] == user_name):
-                    row_data.append("Draw")
-                else:
-                    "uhhh you didn't play in this game..."
-
-                
-                row_data.extend([move_num, white_accuracy, black_accuracy, len(black_blunders), len(black_mistakes), len(white_blunders), len(white_mistakes)])
-
-                try:
-                    row_data.append(black_blunders[0])
-                except IndexError:
-                    row_data.append('')
-            
-                try:
-                    row_data.append(black_mistakes[0])
-                except IndexError:
-                    row_data.append('')
-            
-                try:
-                    row_data.append(white_blunders[0])
-                except IndexError:
-                    row_data.append('')
-                
-                try:
-                    row_data.append(white_mistakes[0])
-                except IndexError:
-                    row_data.append('')
-
+            game_count = 0 # Rows come back in the same order as the games in the PGN file
+            for row_data in executor.map(analyze_one_game, read_pgn_games(pgn_file), itertools.repeat(user_name)):
                 writer.writerow(row_data)
                 game_count += 1
 
@@ -1,59 +1,82 @@
 import requests
 import os
+import shutil
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
-def download_pgns(username, email, year, months, output_dir="pgn_downloads"):
+def download_month(session, username, year, month, output_dir):
     """
-    Downloads the PGN and .txt versions of the game data from Chess.com API
+    Downloads the PGN and .txt versions of a single month of game data from Chess.com API. Used by download_pgns to download the months at the same time.
 
     Args:
+        session (requests.Session): session with the User-Agent header already set, shared by all of the months
         username (str): Your Chess.com username.
-        email (str): Your Chess.com email
         year (str): The year (e.g., "2024").
-        months (list):  list of month (e.g., ['01','02','03]").
-        output_dir (str, optional): Directory to save the PGN file. Defaults to "pgn_downloads".
-
-    Returns:
-        output_dir (str): Directory where the files were saved. This is outputted so that it can be utilized when running the merge_files function. 
+        month (str): The month (e.g., "01").
+        output_dir (str): Directory to save the PGN file.
     """
-    
-    for month in months: #looping through the months list to create unique urls for each month
-        txt_url = f"https://api.chess.com/pub/player/{username}/games/{year}/{month}"
-        pgn_url = f"https://api.chess.com/pub/player/{username}/games/{year}/{month}/pgn"
-        print(f"Attempting to download files for {month} of {year}")
+    txt_url = f"https://api.chess.com/pub/player/{username}/games/{year}/{month}"
+    pgn_url = f"https://api.chess.com/pub/player/{username}/games/{year}/{month}/pgn"
+    print(f"Attempting to download files for {month} of {year}")
+
+    try:
+        pgn_response = session.get(pgn_url)
+        pgn_response.raise_for_status()  # Raise an exception for bad status codes
+
+        txt_response = session.get(txt_url)
+        txt_response.raise_for_status()  # Raise an exception for bad status codes
+
+        pgn_content = pgn_response.text
+        txt_content = txt_response.text
+
+        pgn_filename = f"{username}_{year}_{month}.pgn"
+        pgn_filepath = os.path.join(output_dir, pgn_filename)
 
-        try:
-            #headers are required  on the requests.get or you will get 403 error. This is why email address is a required input.
-            pgn_response = requests.get(pgn_url, headers = {'User-Agent': 'username: {username}, email: {email}'}) 
-            pgn_response.raise_for_status()  # Raise an exception for bad status codes
+        with open(pgn_filepath, "w") as f:
+            f.write(pgn_content)
 
-            txt_response = requests.get(txt_url, headers = {'User-Agent': 'username: {username}, email: {email}'}) 
-            txt_response.raise_for_status()  # Raise an exception for bad status codes
+        txt_filename = f"{username}_{year}_{month}.txt"
+        txt_filepath = os.path.join(output_dir, txt_filename)
 
-            pgn_content = pgn_response.text
-            txt_content = txt_response.text
+        with open(txt_filepath, "w") as f:
+            f.write(txt_content)
 
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
+        print(f"Successfully downloaded PGNs for {year}-{month} to: {pgn_filepath} (compression: {pgn_response.headers.get('Content-Encoding', 'none')})")
 
-            pgn_filename = f"{username}_{year}_{month}.pgn"
-            pgn_filepath = os.path.join(output_dir, pgn_filename)
+    except requests.exceptions.RequestException as e:
+        print(f"Error downloading PGNs: {e}")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
 
-            with open(pgn_filepath, "w") as f:
-                f.write(pgn_content)
+def download_pgns(username, email, year, months, output_dir="pgn_downloads", max_workers=8):
+    """
+    Downloads the PGN and .txt versions of the game data from Chess.com API
+
+    Args:
+        username (str): Your Chess.com username.
+        email (str): Your Chess.com email
+        year (str): The year (e.g., "2024").
+        months (list):  list of month (e.g., ['01','02','03]").
+        output_dir (str, optional): Directory to save the PGN file. Defaults to "pgn_downloads".
+        max_workers (int, optional): How many months to download at the same time. Defaults to 8.
 
-            txt_filename = f"{username}_{year}_{month}.txt"
-            txt_filepath = os.path.join(output_dir, txt_filename)
+    Returns:
+        output_dir (str): Directory where the files were saved. This is outputted so that it can be utilized when running the merge_files function. 
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-            with open(txt_filepath, "w") as f:
-                f.write(txt_content)
+    # One session for every request so the connection to chess.com is kept open and reused instead of reconnecting for every file
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max_workers)) #one pooled connection per download thread
+    #headers are required on every request or you will get 403 error. This is why email address is a required input.
+    #requests already asks for compressed responses (Accept-Encoding) and decompresses them, so only the User-Agent needs to be set.
+    session.headers.update({'User-Agent': f'username: {username}, email: {email}'})
 
-            print(f"Successfully downloaded PGNs for {year}-{month} to: {pgn_filepath}")
+    # The months are independent of each other, so they are downloaded at the same time rather than waiting for each one to finish
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(functools.partial(download_month, session, username, year, output_dir=output_dir), months))
 
-        except requests.exceptions.RequestException as e:
-            print(f"Error downloading PGNs: {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-        
     return output_dir
 
 def get_txt_and_pgn_filenames(path):
@@ -64,22 +87,24 @@ def get_txt_and_pgn_filenames(path):
         path(str): the path where the .txt and .pgn files are located
     
     Returns:
-        txt_file_names (list): list of all .txt files in the path
-        pgn_file_names (list): list of all .pgnfiles in the path
+        txt_file_names (list): sorted list of all .txt files in the path
+        pgn_file_names (list): sorted list of all .pgnfiles in the path
     """
     txt_file_names = []
     pgn_file_names = []
 
     if os.path.exists(path):
-        for item in os.listdir(path):
-            if os.path.isfile(os.path.join(path,item)):
-                if os.path.splitext(item)[1] == '.txt':
-                    txt_file_names.append(item)
-                elif os.path.splitext(item)[1] == '.pgn':
-                    pgn_file_names.append(item)
+        with os.scandir(path) as entries: #scandir already knows which entries are files, so no extra os.path.isfile call per item
+            for entry in entries:
+                if entry.is_file():
+                    extension = os.path.splitext(entry.name)[1]
+                    if extension == '.txt':
+                        txt_file_names.append(entry.name)
+                    elif extension == '.pgn':
+                        pgn_file_names.append(entry.name)
     else:
         raise FileNotFoundError(f"(The directory {path} was not found.")
-    return txt_file_names, pgn_file_names
+    return sorted(txt_file_names), sorted(pgn_file_names) #os.scandir doesn't return the files in any particular order, so sort them to merge both file types with the months in the same order
 
 def merge_files(path, file_list, output_file):
     """
@@ -90,15 +115,15 @@ def merge_files(path, file_list, output_file):
         file_list(list): the list of the individual files
         output_file(str): the name you want to give the final merged file
     """
-    with open(output_file, 'w') as outfile:
+    with open(output_file, 'wb') as outfile: #binary mode so the files are copied in 1 MB blocks without being decoded line by line
         for filename in file_list:
+            file_path = os.path.join(path, filename)
             try:
-                with open(path + "/" + filename, 'r') as infile:
-                    for line in infile:
-                        outfile.write(line)
-                    outfile.write("\n\n") #want to consistently start the next file with two newlines following the end of the previous file. 
+                with open(file_path, 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile, length=1024*1024)
+                    outfile.write(b"\n\n") #want to consistently start the next file with two newlines following the end of the previous file. 
             except FileNotFoundError:
-                print(f"File not found: {path + "/" + filename}")
+                print(f"File not found: {file_path}")
             
 
 if __name__ == "__main__":
@@ -111,5 +136,5 @@ if __name__ == "__main__":
 
     txt_file_names, pgn_file_names = get_txt_and_pgn_filenames(path)
 
-    merge_files(path, txt_file_names, path + "/combined_txt_file.txt")
-    merge_files(path, pgn_file_names, path + "/combined_pgn_file.pgn")
\ No newline at end of file
+    merge_files(path, txt_file_names, os.path.join(path, "combined_txt_file.txt"))
+    merge_files(path, pgn_file_names, os.path.join(path, "combined_pgn_file.pgn"))
\ No newline at end of file